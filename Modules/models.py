@@ -62,7 +62,8 @@ def mnase_Etienne(winsize=2001, **kwargs):
             MaxPool1D(2, padding="same"),
             BatchNormalization(),
             Flatten(),
-            Dense(1, activation="relu"),
+            # Output in float32 for numerical stability with mixed precision
+            Dense(1, activation="relu", dtype="float32"),
         ]
     )
     return model
@@ -167,12 +168,14 @@ def bassenji_Etienne(winsize=32768, **kwargs):
     x4 = Dropout(0.2)(x)
 
     x = concatenate([x1, x2, x3, x4], axis=2)
+    # Output in float32 for numerical stability with mixed precision
     x = Conv1D(
         1,
         kernel_size=1,
         padding="same",
         activation="relu",
         kernel_initializer=kernel_init,
+        dtype="float32",
     )(x)
     model = tf.keras.Model(input_layer, x)
     return model
@@ -1,9 +1,358 @@
 #!/usr/bin/env python
+import os
+
 import keras.backend as K
 import numpy as np
+import tensorflow as tf
 from Modules import utils
 from tensorflow.keras.utils import Sequence
 
+try:
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    # numpy < 1.20, e.g. the 1.19.5 pinned in the tf2.5 environments
+    from numpy.lib.stride_tricks import as_strided
+
+    def sliding_window_view(x, window_shape):
+        """Minimal backport of numpy's sliding_window_view.
+
+        Only supports a `window_shape` covering all dimensions of `x`, which
+        is how it is used in this module.
+        """
+        window_shape = tuple(window_shape)
+        out_shape = tuple(np.subtract(x.shape, window_shape) + 1) + window_shape
+        return as_strided(
+            x, shape=out_shape, strides=x.strides + x.strides, writeable=False
+        )
+
+
+def _window_masks(
+    data,
+    labels,
+    winsize,
+    head_interval=None,
+    remove_indices=None,
+    remove0s=False,
+    removeNs=False,
+):
+    """Select indices of valid windows, using masked arrays.
+
+    Some window indices are totally removed from the training set, but
+    with multiple heads, some individual labels can be removed from one
+    of the heads without throwing away the window. This is done by
+    weighting these labels to 0.
+
+    Parameters
+    ----------
+    data : ndarray, shape=(n, 4)
+        2D-array of one-hot encoded chromosome.
+    labels : ndarray, shape=(n,)
+        array of labels for each base of the chromosome.
+    winsize : int
+        length of windows to send as input to the model
+    head_interval : int, default=None
+        For multiple outputs accross the entire window, specifies spacing
+        between each head. head will start on the far left of the window.
+    remove_indices : ndarray, default=None
+        1D-array of indices of labels to remove from training.
+    remove0s : bool, default=False
+        Specifies to remove all labels equal to 0 from training.
+    removeNs : bool, default=False
+        Specifies to remove all windows containing Ns from training.
+
+    Returns
+    -------
+    indexes : ndarray
+        1D-array of valid window indexes for training. Indexes correspond
+        to the center of the window in `data`.
+    masked_labels : MaskedArray
+        1D-array of labels to use for training, invalid labels are masked.
+    """
+    indexes = np.ma.arange(len(data))
+    masked_labels = np.ma.array(labels, mask=False)
+    # Remove indices of edge windows
+    edge_window_mask = (indexes < winsize // 2) | (
+        indexes >= len(data) - ((winsize - 1) // 2)
+    )
+    if not head_interval:
+        # With multiple heads, even edge labels can be predicted
+        masked_labels[edge_window_mask] = np.ma.masked
+    indexes[edge_window_mask] = np.ma.masked
+    if removeNs:
+        # Remove windows containing at least one N
+        N_mask = np.sum(data, axis=1) == 0
+        N_window_mask = np.asarray(
+            np.convolve(N_mask, np.ones(winsize), mode="same"), dtype=int
+        )
+        masked_labels[N_window_mask] = np.ma.masked
+        indexes[N_window_mask] = np.ma.masked
+    if remove0s:
+        masked_labels[labels == 0] = np.ma.masked
+        if not head_interval:
+            indexes[labels == 0] = np.ma.masked
+    if remove_indices is not None:
+        masked_labels[remove_indices] = np.ma.masked
+        if not head_interval:
+            indexes[remove_indices] = np.ma.masked
+    return indexes.compressed(), masked_labels
+
+
+def window_dataset(
+    data,
+    labels,
+    winsize,
+    batch_size,
+    max_data,
+    shuffle=True,
+    same_samples=False,
+    drop_remainder=False,
+    cache=None,
+    balance=None,
+    n_classes=500,
+    strand="both",
+    head_interval=None,
+    remove_indices=None,
+    remove0s=False,
+    removeNs=False,
+    seed=None,
+    device=None,
+):
+    """Build a tf.data.Dataset of chromosome windows for training.
+
+    This is the tf.data counterpart of `WindowGenerator`: window selection
+    and weighting follow the same rules, but windows are gathered inside
+    the tf.data pipeline, which allows parallel extraction and prefetching
+    to overlap with the training step instead of blocking it.
+
+    Parameters
+    ----------
+    data : ndarray, shape=(n, 4)
+        2D-array of one-hot encoded chromosome.
+    labels : ndarray, shape=(n,)
+        array of labels for each base of the chromosome.
+    winsize : int
+        length of windows to send as input to the model
+    batch_size : int
+        number of windows to send per batch
+    max_data : int
+        maximum number of windows per epoch (before evaluating on the
+        validation set)
+    shuffle : bool, default=True
+        If True, indicates to shuffle windows, reshuffling at each epoch.
+    same_samples : bool, default=False
+        If True, indicates to use the same sample at each epoch. Otherwise a
+        new sample of `max_data` windows is drawn at each epoch.
+    drop_remainder : bool, default=False
+        If True, drop the last batch when it has less than `batch_size`
+        windows, keeping batch shapes static.
+    cache : str, default=None
+        If set, cache materialized windows so epochs after the first skip
+        window extraction. 'ram' caches in memory, any other value is used
+        as a cache file path. Caching materializes all `max_data` windows,
+        which can require a lot of memory or disk, and fixes the sample
+        across epochs.
+    balance : {None, "batch", "global"}, default=None
+        "batch" indicates to balance weights among classes inside each batch,
+        while "global" indicates to balance on the entire data. Default value
+        None indicates not to balance weights.
+    n_classes : int, default=500
+        If `balance` is set, indicates number of bins to divide the signal
+        range in, for determining classes.
+    strand : {'for', 'rev', 'both'}, default='both'
+        Indicates which strand to use for training. If 'both', half the
+        windows of each batch are reversed.
+    head_interval : int, default=None
+        For multiple outputs accross the entire window, specifies spacing
+        between each head. head will start on the far left of the window.
+    remove_indices : ndarray, default=None
+        1D-array of indices of labels to remove from training.
+    remove0s : bool, default=False
+        Specifies to remove all labels equal to 0 from training.
+    removeNs : bool, default=False
+        Specifies to remove all windows containing Ns from training.
+    seed : int, default=None
+        Seed to use for random shuffles
+    device : str, default=None
+        If set, prefetch batches directly onto this device (e.g. '/GPU:0'),
+        taking the host-to-device copy off the critical path. Do not set it
+        when training under a distribution strategy, which places batches on
+        replicas itself.
+
+    Returns
+    -------
+    dataset : tf.data.Dataset
+        Dataset yielding batches of (window, labels, weights), ready to be
+        passed to `model.fit`.
+    steps : int or None
+        Number of batches per epoch, to pass to `model.fit` as
+        steps_per_epoch/validation_steps. None when Keras can infer it from
+        the dataset itself; a device transfer hides the cardinality, so the
+        count is only returned when `device` is set.
+    """
+    try:
+        assert 0 <= np.min(labels)
+        assert np.max(labels) <= 1
+        assert np.allclose(np.min(labels), 0)
+        assert np.allclose(np.max(labels), 1)
+    except AssertionError:
+        print("labels must be normalized between 0 and 1")
+        raise
+
+    indexes, masked_labels = _window_masks(
+        data,
+        labels,
+        winsize,
+        head_interval=head_interval,
+        remove_indices=remove_indices,
+        remove0s=remove0s,
+        removeNs=removeNs,
+    )
+    if max_data > len(indexes):
+        max_data = len(indexes)
+    if balance == "global":
+        # Determine weights with effective labels
+        y_eff = masked_labels[indexes].compressed()
+        bin_values, bin_edges = np.histogram(y_eff, bins=n_classes, range=(0, 1))
+        # Weight all labels for convenience
+        bin_idx = np.digitize(labels, bin_edges)
+        bin_idx[bin_idx == n_classes + 1] = n_classes
+        bin_idx -= 1
+        weights = len(y_eff) / (n_classes * bin_values[bin_idx])
+    else:
+        weights = np.ones(len(data))
+    # Weight invalid labels to 0
+    weights[masked_labels.mask] = 0
+
+    if shuffle:
+        if seed is not None:
+            np.random.seed(seed)
+        np.random.shuffle(indexes)
+    if same_samples or cache is not None:
+        # Restrict to a fixed sample, reused at each epoch. Caching requires
+        # a fixed sample too, otherwise cached windows could not be reused.
+        indexes = indexes[:max_data]
+
+    # Keep full arrays as tensors, windows are gathered on the fly.
+    # Windows are cast from the compact storage dtype (int8/bool) to the
+    # model's compute dtype only once gathered.
+    compute_dtype = tf.keras.mixed_precision.global_policy().compute_dtype
+    data_t = tf.constant(data)
+    labels_t = tf.constant(labels, dtype=tf.float32)
+    weights_t = tf.constant(weights, dtype=tf.float32)
+    offsets = tf.constant(
+        np.arange(-(winsize // 2), (winsize - 1) // 2 + 1), dtype=tf.int64
+    )
+    if head_interval:
+        head_offsets = tf.constant(
+            np.arange(-(winsize // 2), (winsize - 1) // 2 + 1, head_interval),
+            dtype=tf.int64,
+        )
+
+    ds = tf.data.Dataset.from_tensor_slices(indexes)
+    if cache is None:
+        # Shuffle window indexes before gathering, it is much cheaper than
+        # shuffling materialized windows
+        if shuffle:
+            ds = ds.shuffle(
+                buffer_size=min(len(indexes), 2**20),
+                seed=seed,
+                reshuffle_each_iteration=True,
+            )
+        if not same_samples:
+            # With reshuffling, this draws a new sample at each epoch
+            ds = ds.take(max_data)
+    if strand == "both":
+        # Alternate strands so that half of each batch is reversed
+        strand_flags = tf.data.Dataset.range(2).map(lambda i: i % 2 == 0).repeat()
+        ds = tf.data.Dataset.zip((ds, strand_flags))
+    else:
+        ds = ds.map(lambda idx: (idx, strand == "rev"))
+
+    def make_window(idx, reverse):
+        # Windows are gathered on the forward strand, reverse complementing
+        # is done on whole batches. Heads are read from the far right on the
+        # reverse strand.
+        window = tf.cast(tf.gather(data_t, idx + offsets), compute_dtype)
+        if head_interval:
+            heads = idx + head_offsets
+            if strand in ("rev", "both"):
+                rev_heads = tf.reverse(heads, axis=[0]) + head_interval - 1
+                heads = tf.where(reverse, rev_heads, heads)
+        else:
+            heads = tf.expand_dims(idx, axis=0)
+        return (
+            window,
+            reverse,
+            tf.gather(labels_t, heads),
+            tf.gather(weights_t, heads),
+        )
+
+    ds = ds.map(make_window, num_parallel_calls=tf.data.AUTOTUNE)
+    if cache is not None:
+        # Cache materialized windows, epochs after the first read from the
+        # cache instead of re-gathering, and reshuffle from the cache
+        ds = ds.cache("" if cache == "ram" else cache)
+        if shuffle:
+            ds = ds.shuffle(
+                buffer_size=min(len(indexes), 2**14),
+                seed=seed,
+                reshuffle_each_iteration=True,
+            )
+    ds = ds.batch(batch_size, drop_remainder=drop_remainder)
+
+    # Reverse complement flagged windows as a single vectorized op on the
+    # whole batch, and drop the strand flag
+    def reverse_complement(window, reverse, y, w):
+        if strand == "rev":
+            window = tf.reverse(window, axis=[1, 2])
+        elif strand == "both":
+            window = tf.where(
+                reverse[:, None, None], tf.reverse(window, axis=[1, 2]), window
+            )
+        return window, y, w
+
+    ds = ds.map(reverse_complement, num_parallel_calls=tf.data.AUTOTUNE)
+    if balance == "batch":
+        # Divide continuous labels into classes and balance weights
+        def balance_batch(window, y, w):
+            valid = w > 0
+            y_eff = tf.boolean_mask(y, valid)
+            bin_values = tf.histogram_fixed_width(y_eff, [0.0, 1.0], nbins=n_classes)
+            bin_idx = tf.clip_by_value(
+                tf.cast(y * n_classes, tf.int32), 0, n_classes - 1
+            )
+            batch_weights = tf.cast(tf.size(y_eff), tf.float32) / tf.cast(
+                n_classes * tf.gather(bin_values, bin_idx), tf.float32
+            )
+            # Weight invalid labels to 0
+            batch_weights = tf.where(valid, batch_weights, 0.0)
+            return window, y, batch_weights
+
+        ds = ds.map(balance_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    # Autotune the pipeline and let transformations run out of order
+    opts = tf.data.Options()
+    opts.experimental_deterministic = False
+    opts.experimental_threading.private_threadpool_size = os.cpu_count()
+    opts.experimental_optimization.autotune = True
+    ds = ds.with_options(opts)
+    if device is not None:
+        # The device transfer goes through a generator dataset, which hides
+        # the cardinality from Keras, so count batches while it is known and
+        # return the count for explicit steps_per_epoch/validation_steps.
+        n_batches = int(tf.data.experimental.cardinality(ds))
+        # With explicit step counts Keras keeps the same iterator across
+        # epochs, so the dataset must repeat (shuffling still redraws the
+        # sample on each repetition)
+        ds = ds.repeat()
+        # Batches are copied to the device ahead of the step that needs them
+        ds = ds.apply(
+            tf.data.experimental.prefetch_to_device(
+                device, buffer_size=tf.data.AUTOTUNE
+            )
+        )
+        return ds, n_batches
+    return ds.prefetch(tf.data.AUTOTUNE), None
+
 
 class WindowGenerator(Sequence):
     """
@@ -92,6 +441,9 @@ class WindowGenerator(Sequence):
         1D-array of labels to use for training, invalid labels are masked.
         This complements `indexes` for multiple heads, when a window must be
         kept but some heads must be discarded
+    windows : ndarray, shape=(n-winsize+1, winsize, 4)
+        zero-copy strided view of all windows of `data`, indexed by window
+        start position
     sample : ndarray
         1D-array of indexes to use for the current epoch
     weights : ndarray
@@ -145,39 +497,22 @@ class WindowGenerator(Sequence):
             raise
 
         # Select indices of windows to train on, using masked arrays
-        # Some window indices are totally removed from the training set, but
-        # with multiple heads, some individual labels can be removed from one
-        # of the heads without throwing away the window. This is done by
-        # weighting these labels to 0.
         # `self.indexes` stores windows used for training
         # `self.masked_labels` is a masked array with all invalid labels masked
-        self.indexes = np.ma.arange(len(self.data))
-        self.masked_labels = np.ma.array(self.labels, mask=False)
-        # Remove indices of edge windows
-        edge_window_mask = (self.indexes < self.winsize // 2) | (
-            self.indexes >= len(self.data) - ((self.winsize - 1) // 2)
+        self.indexes, self.masked_labels = _window_masks(
+            self.data,
+            self.labels,
+            self.winsize,
+            head_interval=self.head_interval,
+            remove_indices=self.remove_indices,
+            remove0s=self.remove0s,
+            removeNs=removeNs,
         )
-        if not self.head_interval:
-            # With multiple heads, even edge labels can be predicted
-            self.masked_labels[edge_window_mask] = np.ma.masked
-        self.indexes[edge_window_mask] = np.ma.masked
-        if removeNs:
-            # Remove windows containing at least one N
-            N_mask = np.sum(self.data, axis=1) == 0
-            N_window_mask = np.asarray(
-                np.convolve(N_mask, np.ones(self.winsize), mode="same"), dtype=int
-            )
-            self.masked_labels[N_window_mask] = np.ma.masked
-            self.indexes[N_window_mask] = np.ma.masked
-        if self.remove0s:
-            self.masked_labels[self.labels == 0] = np.ma.masked
-            if not self.head_interval:
-                self.indexes[self.labels == 0] = np.ma.masked
-        if self.remove_indices is not None:
-            self.masked_labels[self.remove_indices] = np.ma.masked
-            if not self.head_interval:
-                self.indexes[self.remove_indices] = np.ma.masked
-        self.indexes = self.indexes.compressed()
+        # Zero-copy view of all windows, window starts are window centers
+        # shifted by winsize//2
+        self.windows = sliding_window_view(
+            self.data, (self.winsize, self.data.shape[-1])
+        )[:, 0]
 
         # Set max_data to only take less than all the indexes
         if self.max_data > len(self.indexes):
@@ -228,11 +563,8 @@ class WindowGenerator(Sequence):
         """
         # Get window center idxes
         batch_idxes = self.sample[idx * self.batch_size : (idx + 1) * self.batch_size]
-        # Get full window idxes
-        window_indices = batch_idxes.reshape(-1, 1) + np.arange(
-            -(self.winsize // 2), (self.winsize - 1) // 2 + 1
-        ).reshape(1, -1)
-        batch_x = self.data[window_indices]
+        # Extract windows from the strided view (copies only the batch)
+        batch_x = self.windows[batch_idxes - self.winsize // 2]
         # Determine head indices for labels
         if self.head_interval:
             head_indices = batch_idxes.reshape(-1, 1) + np.arange(
@@ -316,6 +648,11 @@ class PredGenerator(Sequence):
         self.batch_size = batch_size
         self.indexes = np.arange(self.winsize // 2, len(data) - (self.winsize // 2))
         self.extradims = extradims
+        # Zero-copy view of all windows, window starts are window centers
+        # shifted by winsize//2
+        self.windows = sliding_window_view(
+            self.data, (2 * (self.winsize // 2) + 1, self.data.shape[-1])
+        )[:, 0]
 
     def __len__(self):
         return int(np.ceil(len(self.data) / self.batch_size))
@@ -323,11 +660,8 @@ class PredGenerator(Sequence):
     def __getitem__(self, idx):
         # Get window center idxes
         batch_idxes = self.indexes[idx * self.batch_size : (idx + 1) * self.batch_size]
-        # Get full window idxes
-        window_indices = batch_idxes.reshape(-1, 1) + np.arange(
-            -(self.winsize // 2), self.winsize // 2 + 1
-        ).reshape(1, -1)
-        batch_x = self.data[window_indices]
+        # Extract windows from the strided view (copies only the batch)
+        batch_x = self.windows[batch_idxes - self.winsize // 2]
         if self.extradims is not None:
             batch_x = np.expand_dims(batch_x, axis=self.extradims)
         batch_y = np.zeros((len(batch_x), 1))
@@ -50,7 +50,9 @@ def write_bw(filename: Union[Path, str], arrays: Dict[str, np.ndarray]) -> None:
     bw.close()
 
 
-def merge_chroms(chr_ids: Iterable[str], file: str) -> np.ndarray:
+def merge_chroms(
+    chr_ids: Iterable[str], file: str, dtype: type = None, mmap: bool = False
+) -> np.ndarray:
     """Concatenate chromosomes by interspacing them with a value of 0.
 
     Parameters
@@ -60,19 +62,50 @@ def merge_chroms(chr_ids: Iterable[str], file: str) -> np.ndarray:
     file : str
         Name of an npz file containing one-hot encoded chromosomes.
         The length of the chromosome must be the first dimension.
+    dtype : type, optional
+        Data type to convert the arrays to. Default value of None keeps the
+        dtype stored in `file`. One-hot encoded genomes can be stored as int8
+        to reduce memory traffic, 1 byte per base is enough for 0/1 values.
+    mmap : bool, optional
+        If True, save the merged array to a .npy sidecar file next to `file`
+        on first use and memory-map it read-only afterwards. npz archives are
+        zip-compressed and cannot be mapped, whereas the mapped sidecar is
+        served from the OS page cache and shared between runs instead of
+        being decompressed into private RAM every time.
 
     Returns
     -------
     ndarray
         Concatenated one-hot encoded array.
     """
-    annot = []
+    if mmap:
+        # Sidecar name encodes the merge parameters, stale caches are rebuilt
+        tag = "_".join(chr_ids)
+        if dtype is not None:
+            tag += f"_{np.dtype(dtype).name}"
+        cache_file = Path(f"{file}.{tag}.npy")
+        if (
+            cache_file.is_file()
+            and cache_file.stat().st_mtime >= Path(file).stat().st_mtime
+        ):
+            return np.load(cache_file, mmap_mode="r")
     with np.load(file) as f:
-        for chr_id in chr_ids:
-            annot.append(f[chr_id])
-            shape, dtype = f[chr_id].shape, f[chr_id].dtype
-            annot.append(np.zeros((1,) + shape[1:], dtype=dtype))
-    return np.concatenate(annot)
+        # Decompress each chromosome only once
+        arrays = [f[chr_id] for chr_id in chr_ids]
+    if dtype is None:
+        dtype = np.result_type(*arrays)
+    # Fill a preallocated array instead of concatenating, the interspaced
+    # zeros are already there
+    total_len = sum(len(arr) + 1 for arr in arrays)
+    merged = np.zeros((total_len,) + arrays[0].shape[1:], dtype=dtype)
+    offset = 0
+    for arr in arrays:
+        merged[offset : offset + len(arr)] = arr
+        offset += len(arr) + 1
+    if mmap:
+        np.save(cache_file, merged)
+        return np.load(cache_file, mmap_mode="r")
+    return merged
 
 
 def read_fasta(file: str) -> Dict[str, str]:
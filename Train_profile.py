@@ -3,6 +3,7 @@
 import argparse
 import datetime
 import json
+import os
 import socket
 import sys
 import time
@@ -20,6 +21,11 @@ from tensorflow.keras.callbacks import (
 )
 from tensorflow.keras.optimizers import Adam
 
+# JIT-compile the custom loss and metric, they only use keras.backend ops
+# so they fuse into the XLA cluster of the training step
+mae_cor = tf.function(mae_cor, jit_compile=True)
+correlate = tf.function(correlate, jit_compile=True)
+
 
 def parsing():
     """
@@ -145,6 +151,16 @@ def parsing():
         default=2**20,
         type=int,
     )
+    parser.add_argument(
+        "--cache",
+        help="Indicates to cache training windows so epochs after the first "
+        "skip window extraction. 'ram' caches in memory, any other value is "
+        "used as a cache file path. Caching materializes all training windows, "
+        "which can require a lot of memory or disk, and fixes the sample "
+        "across epochs (default: %(default)s)",
+        default=None,
+        type=str,
+    )
     parser.add_argument(
         "-bal",
         "--balance",
@@ -235,22 +251,26 @@ def parsing():
     elif genome_name == "W303_Mmmyco":
         args.chrom_train = [f"chr{c}" if c != "Mmmyco" else c for c in args.chrom_train]
         args.chrom_valid = [f"chr{c}" if c != "Mmmyco" else c for c in args.chrom_valid]
+    # Only read archive keys, no chromosome needs to be decompressed here
     with np.load(args.genome) as g:
-        with np.load(args.labels) as s:
-            for chr_id in args.chrom_train + args.chrom_valid:
-                if not (chr_id in g.keys() and chr_id in s.keys()):
-                    sys.exit(
-                        f"{chr_id} is not a valid chromosome id in "
-                        f"{args.genome} and {args.labels}"
-                    )
+        g_keys = set(g.files)
+    with np.load(args.labels) as s:
+        s_keys = set(s.files)
+    for chr_id in args.chrom_train + args.chrom_valid:
+        if not (chr_id in g_keys and chr_id in s_keys):
+            sys.exit(
+                f"{chr_id} is not a valid chromosome id in "
+                f"{args.genome} and {args.labels}"
+            )
     if args.remove_indices is not None:
         with np.load(args.remove_indices) as r:
-            for chr_id in args.chrom_train + args.chrom_valid:
-                if chr_id not in r.keys():
-                    sys.exit(
-                        f"{chr_id} is not a valid chromosome id in "
-                        f"{args.remove_indices}"
-                    )
+            r_keys = set(r.files)
+        for chr_id in args.chrom_train + args.chrom_valid:
+            if chr_id not in r_keys:
+                sys.exit(
+                    f"{chr_id} is not a valid chromosome id in "
+                    f"{args.remove_indices}"
+                )
     return args
 
 
@@ -260,6 +280,17 @@ if __name__ == "__main__":
     args = parsing()
     # Maybe build output directory
     Path(args.output).mkdir(parents=True, exist_ok=True)
+    # Persist the XLA compilation cache next to the experiment so reruns
+    # (e.g. hyperparameter sweeps) skip the first-epoch compilation. The
+    # flag only exists from TF 2.11, older flag parsers abort on unknown
+    # TF_XLA_FLAGS entries.
+    if tuple(int(v) for v in tf.__version__.split(".")[:2]) >= (2, 11):
+        xla_cache = Path(args.output, "xla_cache")
+        xla_cache.mkdir(exist_ok=True)
+        os.environ["TF_XLA_FLAGS"] = (
+            os.environ.get("TF_XLA_FLAGS", "")
+            + f" --tf_xla_persistent_cache_directory={xla_cache}"
+        ).strip()
     # Store arguments in file
     with open(Path(args.output, "Experiment_info.txt"), "w") as f:
         json.dump(vars(args), f, indent=4)
@@ -267,8 +298,10 @@ if __name__ == "__main__":
         f.write(f"timestamp: {tmstmp}\n")
         f.write(f"machine: {socket.gethostname()}\n")
 
+    # Log device placement only when debugging, it serializes op dispatch
+    if args.verbose >= 3:
+        tf.debugging.set_log_device_placement(True)
     # Limit gpu memory usage
-    tf.debugging.set_log_device_placement(True)
     gpus = tf.config.list_physical_devices("GPU")
     if gpus:
         try:
@@ -277,6 +310,12 @@ if __name__ == "__main__":
         except RuntimeError as e:
             print(e)
 
+    # Enable XLA to fuse ops and reduce kernel launch overhead
+    tf.config.optimizer.set_jit(True)
+
+    # Train in mixed precision, output layers cast back to float32
+    tf.keras.mixed_precision.set_global_policy("mixed_float16")
+
     # Set random seed for tensorflow model initialisation
     if args.seed is not None:
         tf.random.set_seed(args.seed)
@@ -286,52 +325,73 @@ if __name__ == "__main__":
         "bassenji_Etienne": models.bassenji_Etienne,
     }
     model_builder = model_dict[args.architecture]
-    if args.distribute:
-        strategy = tf.distribute.MirroredStrategy()
-        with strategy.scope():
-            model = model_builder(winsize=args.winsize)
-            model.compile(
-                optimizer=Adam(learning_rate=args.learn_rate),
-                loss=mae_cor,
-                metrics=["mae", correlate],
-            )
-    else:
+
+    def build_and_compile():
+        # Single place for compile options, shared by both strategy branches
         model = model_builder(winsize=args.winsize)
         model.compile(
-            optimizer=Adam(learning_rate=args.learn_rate),
+            optimizer=tf.keras.mixed_precision.LossScaleOptimizer(
+                Adam(learning_rate=args.learn_rate)
+            ),
             loss=mae_cor,
             metrics=["mae", correlate],
+            steps_per_execution=32,
         )
+        return model
 
-    # Load the data
-    x_train = utils.merge_chroms(args.chrom_train, args.genome)
-    x_valid = utils.merge_chroms(args.chrom_valid, args.genome)
-    y_train = utils.merge_chroms(args.chrom_train, args.labels)
-    y_valid = utils.merge_chroms(args.chrom_valid, args.labels)
+    if args.distribute and len(gpus) > 1:
+        # NCCL all-reduce, global batch scaled by the number of replicas
+        strategy = tf.distribute.MirroredStrategy(
+            cross_device_ops=tf.distribute.NcclAllReduce()
+        )
+        args.batch_size *= strategy.num_replicas_in_sync
+        with strategy.scope():
+            model = build_and_compile()
+    else:
+        model = build_and_compile()
+
+    # Load the data, one-hot genome as int8 to quarter memory traffic, and
+    # memory-mapped from .npy sidecars so reruns skip npz decompression
+    x_train = utils.merge_chroms(
+        args.chrom_train, args.genome, dtype=np.int8, mmap=True
+    )
+    x_valid = utils.merge_chroms(
+        args.chrom_valid, args.genome, dtype=np.int8, mmap=True
+    )
+    y_train = utils.merge_chroms(args.chrom_train, args.labels, mmap=True)
+    y_valid = utils.merge_chroms(args.chrom_valid, args.labels, mmap=True)
     if args.remove_indices is not None:
         with np.load(args.remove_indices) as f:
             with np.load(args.labels) as s:
-                remove_indices_train, remove_indices_valid = [], []
-                total_len_train, total_len_valid = 0, 0
-                for k in args.chrom_train:
-                    remove_indices_train.append(f[k] + total_len_train)
-                    total_len_train += len(s[k]) + 1
-                remove_indices_train = np.concatenate(remove_indices_train)
-                for k in args.chrom_valid:
-                    remove_indices_valid.append(f[k] + total_len_valid)
-                    total_len_valid += len(s[k]) + 1
-                remove_indices_valid = np.concatenate(remove_indices_valid)
+                # Offsets of each chromosome in the merged arrays
+                lens_train = np.array([len(s[k]) + 1 for k in args.chrom_train])
+                offsets_train = np.concatenate(([0], np.cumsum(lens_train)[:-1]))
+                remove_indices_train = np.concatenate(
+                    [f[k] + off for k, off in zip(args.chrom_train, offsets_train)]
+                )
+                lens_valid = np.array([len(s[k]) + 1 for k in args.chrom_valid])
+                offsets_valid = np.concatenate(([0], np.cumsum(lens_valid)[:-1]))
+                remove_indices_valid = np.concatenate(
+                    [f[k] + off for k, off in zip(args.chrom_valid, offsets_valid)]
+                )
     else:
         remove_indices_train = None
         remove_indices_valid = None
-    # Build generators
-    generator_train = tf_utils.WindowGenerator(
+    # Build datasets, prefetching batches straight onto the GPU when a
+    # single one does the training
+    if gpus and not (args.distribute and len(gpus) > 1):
+        device = "/GPU:0"
+    else:
+        device = None
+    dataset_train, steps_train = tf_utils.window_dataset(
         data=x_train,
         labels=y_train,
         winsize=args.winsize,
         batch_size=args.batch_size,
         max_data=args.max_train,
         same_samples=args.same_samples,
+        drop_remainder=True,
+        cache=args.cache,
         balance=args.balance,
         n_classes=args.n_classes,
         strand=args.strand,
@@ -340,8 +400,9 @@ if __name__ == "__main__":
         removeNs=args.removeNs,
         remove_indices=remove_indices_train,
         seed=args.seed,
+        device=device,
     )
-    generator_valid = tf_utils.WindowGenerator(
+    dataset_valid, steps_valid = tf_utils.window_dataset(
         data=x_valid,
         labels=y_valid,
         winsize=args.winsize,
@@ -354,17 +415,19 @@ if __name__ == "__main__":
         removeNs=args.removeNs,
         remove_indices=remove_indices_valid,
         seed=0,
+        device=device,
     )
     # Create callbacks during training
     callbacks_list = [CSVLogger(Path(args.output, "epoch_data.csv"))]
     # Add optional autotune callbakcs
     if not args.disable_autotune:
-        callbacks_list.append(
+        callbacks_list.extend(
             [
                 ModelCheckpoint(
-                    filepath=Path(args.output, "Checkpoint"),
+                    filepath=Path(args.output, "Checkpoint.weights.h5"),
                     monitor="val_correlate",
                     save_best_only=True,
+                    save_weights_only=True,
                 ),
                 EarlyStopping(
                     monitor="val_loss",
@@ -383,12 +446,13 @@ if __name__ == "__main__":
     # Train model
     t0 = time.time()
     model.fit(
-        generator_train,
-        validation_data=generator_valid,
+        dataset_train,
+        validation_data=dataset_valid,
         epochs=args.epochs,
+        steps_per_epoch=steps_train,
+        validation_steps=steps_valid,
         callbacks=callbacks_list,
         verbose=args.verbose,
-        shuffle=False,
     )
     train_time = time.time() - t0
     with open(Path(args.output, "Experiment_info.txt"), "a") as f: